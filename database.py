@@ -5,7 +5,8 @@ MongoDB helper functions ready to use in your backend code.
 Import and use these functions in your API endpoints for database operations.
 """
 
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
+import redis.asyncio as redis
 from datetime import datetime, timezone
 import os
 from dotenv import load_dotenv
@@ -17,17 +18,35 @@ load_dotenv()
 
 _client = None
 db = None
+cache = None
 
 database_url = os.getenv("DATABASE_URL")
 database_name = os.getenv("DATABASE_NAME")
 
 if database_url and database_name:
-    _client = MongoClient(database_url)
+    # Explicit pool bounds: keep warm connections around so hot endpoints skip
+    # the TCP/TLS handshake, and fail fast instead of queueing forever.
+    _client = AsyncIOMotorClient(
+        database_url,
+        maxPoolSize=int(os.getenv("MONGO_MAX_POOL_SIZE", 50)),
+        minPoolSize=int(os.getenv("MONGO_MIN_POOL_SIZE", 5)),
+        maxIdleTimeMS=30000,
+        waitQueueTimeoutMS=2000,
+        retryWrites=True,
+        w="majority",
+        tz_aware=True,
+    )
     db = _client[database_name]
 
+# Optional Redis for short-lived response caching
+redis_url = os.getenv("REDIS_URL")
+
+if redis_url:
+    cache = redis.Redis.from_url(redis_url)
+
 # Helper functions for common database operations
-def create_document(collection_name: str, data: Union[BaseModel, dict]):
-    """Insert a single document with timestamp"""
+async def create_document(collection_name: str, data: Union[BaseModel, dict]):
+    """Insert a single document with timestamp and return it (including _id)"""
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
 
@@ -37,13 +56,16 @@ def create_document(collection_name: str, data: Union[BaseModel, dict]):
     else:
         data_dict = data.copy()
 
-    data_dict['created_at'] = datetime.now(timezone.utc)
-    data_dict['updated_at'] = datetime.now(timezone.utc)
+    # BSON dates hold milliseconds; truncate so the returned doc matches what's stored
+    now = datetime.now(timezone.utc)
+    now = now.replace(microsecond=now.microsecond // 1000 * 1000)
+    data_dict['created_at'] = now
+    data_dict['updated_at'] = now
 
-    result = db[collection_name].insert_one(data_dict)
-    return str(result.inserted_id)
+    await db[collection_name].insert_one(data_dict)  # sets data_dict['_id']
+    return data_dict
 
-def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
+async def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
     """Get documents from collection"""
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
@@ -52,4 +74,4 @@ def get_documents(collection_name: str, filter_dict: dict = None, limit: int = N
     if limit:
         cursor = cursor.limit(limit)
     
-    return list(cursor)
+    return await cursor.to_list(length=None)
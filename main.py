@@ -1,40 +1,209 @@
 import os
-from datetime import datetime
-from typing import Optional, Dict, Any
+import json
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Optional, Dict, Any, List, Literal
 
-from fastapi import FastAPI, HTTPException, Request
+from fastapi import Depends, FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
+import msgspec
 from bson import ObjectId
+from cachetools import TTLCache
+from pymongo import InsertOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
-from database import db, create_document
-from schemas import User, Pet, Tag, ScanEvent, Coupon
+from database import db, cache, create_document
+from schemas import Pet, Tag, ScanEvent, Coupon
 
-app = FastAPI(title="Whoofsy API")
+logger = logging.getLogger(__name__)
+
+SCAN_CACHE_TTL = 60  # seconds
+
+# In-process L1 in front of Redis for hot tags. Invalidation only reaches the
+# local worker, so keep its TTL short: other workers see a status change
+# (e.g. LOST) within a few seconds.
+SCAN_LOCAL_TTL = 5  # seconds
+_scan_local: TTLCache = TTLCache(maxsize=10_000, ttl=SCAN_LOCAL_TTL)
+
+# Static offer shown on every finder page
+_GS_OFFER = {
+    "headline": "Thank you for helping!",
+    "copy": "Get 50% off your first Whoofsy tag.",
+}
+
+# Scan events are written in the background, in batches
+SCAN_BATCH_SIZE = 100
+SCAN_FLUSH_INTERVAL = 0.5  # seconds
+SCAN_FLUSH_RETRIES = 3
+SCAN_QUEUE_MAX = 10_000
+_scan_queue: "asyncio.Queue[Dict[str, Any]]" = asyncio.Queue(maxsize=SCAN_QUEUE_MAX)
+_scan_writer_task: Optional[asyncio.Task] = None
+# Batch the writer was holding when it got cancelled; flushed on shutdown
+_scan_unflushed: List[Dict[str, Any]] = []
+
+app = FastAPI(title="Whoofsy API", default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=[o.strip() for o in os.getenv("CORS_ORIGINS", "https://whoofsy.app").split(",") if o.strip()],
     allow_credentials=True,
-    allow_methods=["*"],
+    allow_methods=["GET", "POST", "PATCH"],
     allow_headers=["*"],
 )
 
 
 # Helpers
 
-def _collection(name: str):
-    if db is None:
-        raise HTTPException(status_code=500, detail="Database unavailable")
-    return db[name]
+def _msgspec_body(model):
+    # Decode a JSON body straight into a msgspec.Struct (C-level validation)
+    async def parse(request: Request):
+        try:
+            return msgspec.json.decode(await request.body(), type=model)
+        except msgspec.DecodeError as e:
+            # Same detail shape as FastAPI's own request validation errors
+            raise HTTPException(422, detail=[{"loc": ["body"], "msg": str(e), "type": "value_error"}])
+
+    return Depends(parse)
 
 
 def _now():
-    return datetime.utcnow()
+    # Millisecond precision, matching what a BSON date round-trips as
+    now = datetime.now(timezone.utc)
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+
+def _scan_cache_key(code: str) -> str:
+    return f"whoofsy:scan:{code}"
+
+
+async def _invalidate_scan(*codes: str):
+    for c in codes:
+        _scan_local.pop(c, None)
+    if cache is None or not codes:
+        return
+    try:
+        await cache.delete(*(_scan_cache_key(c) for c in codes))
+    except Exception as e:
+        logger.warning("Scan cache invalidation failed: %s", e)
+
+
+# Collection handles, bound once at startup
+USER_COL = TAG_COL = PET_COL = SCANEVENT_COL = COUPON_COL = None
+
+
+@app.on_event("startup")
+async def bind_collections():
+    global USER_COL, TAG_COL, PET_COL, SCANEVENT_COL, COUPON_COL
+    if db is None:
+        raise RuntimeError("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+    USER_COL = db["user"]
+    TAG_COL = db["tag"]
+    PET_COL = db["pet"]
+    SCANEVENT_COL = db["scanevent"]
+    COUPON_COL = db["coupon"]
+
+
+@app.on_event("startup")
+async def ensure_indexes():
+    # Back the hot lookups with indexes so they are IXSCANs, not COLLSCANs
+    indexes = [
+        (USER_COL, "email", {"unique": True}),
+        (TAG_COL, "code", {"unique": True}),
+        (TAG_COL, "pet_id", {}),
+        (TAG_COL, "owner_id", {}),
+        (PET_COL, "owner_id", {}),
+        (SCANEVENT_COL, [("code", 1), ("timestamp", -1)], {}),
+        # Only open coupons are ever looked up; unique also guards the
+        # mark_reunion upsert against concurrent duplicates
+        (
+            COUPON_COL,
+            [("code", 1)],
+            {"unique": True, "partialFilterExpression": {"redeemed": False}, "name": "unredeemed_code"},
+        ),
+    ]
+    for col, keys, opts in indexes:
+        try:
+            await col.create_index(keys, **opts)
+        except Exception as e:
+            # Unique indexes back correctness (upserts rely on them), so refuse
+            # to start without them; the rest are only for speed
+            if opts.get("unique"):
+                raise RuntimeError(f"Unique index on {col.name} {keys} could not be built: {e}") from e
+            logger.warning("Index creation on %s failed: %s", col.name, e)
+
+
+async def _flush_scans(batch):
+    error = None
+    for attempt in range(1, SCAN_FLUSH_RETRIES + 1):
+        try:
+            await SCANEVENT_COL.bulk_write([InsertOne(doc) for doc in batch], ordered=False)
+            return
+        except BulkWriteError as e:
+            # InsertOne stamps each doc's _id on the first attempt, so docs that
+            # already landed come back as duplicate keys; retry only the rest
+            failed = {err["index"] for err in e.details.get("writeErrors", []) if err.get("code") != 11000}
+            batch = [doc for i, doc in enumerate(batch) if i in failed]
+            if not batch:
+                return
+            error = e
+        except Exception as e:
+            error = e
+        if attempt < SCAN_FLUSH_RETRIES:
+            await asyncio.sleep(0.5 * attempt)
+    logger.warning("Dropping %d scan events after %d attempts: %s", len(batch), SCAN_FLUSH_RETRIES, error)
+
+
+async def _scan_writer():
+    loop = asyncio.get_running_loop()
+    batch = []
+    try:
+        while True:
+            batch.append(await _scan_queue.get())
+            deadline = loop.time() + SCAN_FLUSH_INTERVAL
+            while len(batch) < SCAN_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(_scan_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            await _flush_scans(batch)
+            batch = []
+    except asyncio.CancelledError:
+        # Shutdown: keep the partial or in-flight batch so it gets flushed
+        _scan_unflushed.extend(batch)
+        raise
+
+
+@app.on_event("startup")
+async def start_scan_writer():
+    global _scan_writer_task
+    _scan_writer_task = asyncio.create_task(_scan_writer())
+
+
+@app.on_event("shutdown")
+async def stop_scan_writer():
+    if _scan_writer_task is not None:
+        _scan_writer_task.cancel()
+        try:
+            await _scan_writer_task
+        except asyncio.CancelledError:
+            pass
+    # Flush whatever is still held or queued
+    batch = list(_scan_unflushed)
+    _scan_unflushed.clear()
+    while not _scan_queue.empty():
+        batch.append(_scan_queue.get_nowait())
+    if batch:
+        await _flush_scans(batch)
 
 
 # Simple auth stub (Google-ready): client passes email+name for now
-class AuthPayload(BaseModel):
+class AuthPayload(msgspec.Struct):
     email: str
     name: Optional[str] = None
     phone: Optional[str] = None
@@ -42,57 +211,62 @@ class AuthPayload(BaseModel):
 
 
 @app.post("/auth/google")
-def auth_google(payload: AuthPayload):
-    col = _collection("user")
-    existing = col.find_one({"email": payload.email})
-    if existing:
-        col.update_one(
-            {"_id": existing["_id"]},
-            {"$set": {"name": payload.name, "phone": payload.phone, "updated_at": _now()}},
-        )
-        user = col.find_one({"_id": existing["_id"]})
-    else:
-        user_model = User(
-            provider="google",
-            external_id=payload.external_id,
-            email=payload.email,
-            name=payload.name,
-            phone=payload.phone,
-            tier="basic",
-            created_at=_now(),
-            updated_at=_now(),
-        )
-        user_id = create_document("user", user_model)
-        user = col.find_one({"_id": ObjectId(user_id)})
-    user["id"] = str(user["_id"])  # normalize
+async def auth_google(payload: AuthPayload = _msgspec_body(AuthPayload)):
+    now = _now()
+    set_fields = {"name": payload.name, "phone": payload.phone, "updated_at": now}
+    insert_fields = {
+        "provider": "google",
+        "email": payload.email,
+        "external_id": payload.external_id,
+        "tier": "basic",
+        "created_at": now,
+    }
+    # Single findAndModify: updates an existing user or inserts a new one
+    user = await USER_COL.find_one_and_update(
+        {"email": payload.email},
+        {"$set": set_fields, "$setOnInsert": insert_fields},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    user["id"] = str(user.pop("_id"))  # normalize
+    # phone is part of the cached finder payload for every tag this user owns
+    codes = [t["code"] async for t in TAG_COL.find({"owner_id": user["id"]}, {"code": 1})]
+    await _invalidate_scan(*codes)
     return user
 
 
 # Tag activation
-class ActivatePayload(BaseModel):
+class ActivatePayload(msgspec.Struct):
     code: str
     user_id: str
-    model: Optional[str] = "smart_tag"
+    model: Literal["smart_tag", "smart_case"] = "smart_tag"
 
 
 @app.post("/tags/activate")
-def activate_tag(p: ActivatePayload):
-    col = _collection("tag")
-    tag = col.find_one({"code": p.code})
-    if tag and tag.get("activated"):
+async def activate_tag(p: ActivatePayload = _msgspec_body(ActivatePayload)):
+    # Explicit guard: don't rely solely on the unique index being present
+    if await TAG_COL.find_one({"code": p.code, "activated": True}, {"_id": 1}):
         raise HTTPException(status_code=400, detail="Tag already activated")
-    if not tag:
-        # Pre-provisioned or create on the fly
-        tag_model = Tag(code=p.code, activated=False, model=p.model, created_at=_now(), updated_at=_now())
-        create_document("tag", tag_model)
-        tag = col.find_one({"code": p.code})
-
-    col.update_one(
-        {"_id": tag["_id"]},
-        {"$set": {"owner_id": p.user_id, "activated": True, "updated_at": _now()}},
+    # Pre-provisioned or create on the fly
+    now = _now()
+    insert_fields = Tag(code=p.code, model=p.model, created_at=now).model_dump(
+        exclude={"owner_id", "activated", "updated_at"}
     )
-    tag = col.find_one({"_id": tag["_id"]})
-    tag["id"] = str(tag["_id"])  # normalize
+    # A tag activated concurrently doesn't match the filter, so the upsert
+    # tries to insert a second doc with the same code and hits the unique index
+    try:
+        tag = await TAG_COL.find_one_and_update(
+            {"code": p.code, "activated": {"$ne": True}},
+            {
+                "$set": {"owner_id": p.user_id, "activated": True, "updated_at": now},
+                "$setOnInsert": insert_fields,
+            },
+            upsert=True,
+            return_document=ReturnDocument.AFTER,
+        )
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Tag already activated")
+    tag["id"] = str(tag.pop("_id"))  # normalize
     return tag
 
 
@@ -104,31 +278,32 @@ class PetPayload(BaseModel):
     color: Optional[str] = None
     medical_notes: Optional[str] = None
     allergies: Optional[str] = None
-    contact_visibility: Optional[str] = "phone"
+    contact_visibility: Literal["phone", "form", "both"] = "phone"
 
 
 @app.post("/pets")
-def create_pet(p: PetPayload):
-    pet_model = Pet(**p.model_dump(), created_at=_now(), updated_at=_now())
-    pet_id = create_document("pet", pet_model)
-    pet = _collection("pet").find_one({"_id": ObjectId(pet_id)})
-    pet["id"] = str(pet["_id"])  # normalize
+async def create_pet(p: PetPayload):
+    # p is already validated; create_document stamps the timestamps
+    pet_model = Pet.model_construct(**p.model_dump())
+    pet = await create_document("pet", pet_model)
+    pet["id"] = str(pet.pop("_id"))  # normalize
     return pet
 
 
 @app.patch("/pets/{pet_id}/status")
-def set_status(pet_id: str, status: str):
+async def set_status(pet_id: str, status: str):
     if status not in ("ACTIVE", "LOST"):
         raise HTTPException(400, detail="Invalid status")
-    col = _collection("pet")
-    res = col.update_one(
+    pet = await PET_COL.find_one_and_update(
         {"_id": ObjectId(pet_id)},
         {"$set": {"status": status, "updated_at": _now()}},
+        return_document=ReturnDocument.AFTER,
     )
-    if not res.matched_count:
+    if pet is None:
         raise HTTPException(404, detail="Pet not found")
-    pet = col.find_one({"_id": ObjectId(pet_id)})
-    pet["id"] = str(pet["_id"])  # normalize
+    codes = [t["code"] async for t in TAG_COL.find({"pet_id": pet_id}, {"code": 1})]
+    await _invalidate_scan(*codes)
+    pet["id"] = str(pet.pop("_id"))  # normalize
     return pet
 
 
@@ -139,18 +314,16 @@ class LinkPayload(BaseModel):
 
 
 @app.post("/tags/link")
-def link_tag(p: LinkPayload):
-    tcol = _collection("tag")
-    pcol = _collection("pet")
-    tag = tcol.find_one({"code": p.code})
+async def link_tag(p: LinkPayload):
+    tag = await TAG_COL.find_one_and_update(
+        {"code": p.code},
+        {"$set": {"pet_id": p.pet_id, "updated_at": _now()}},
+        return_document=ReturnDocument.AFTER,
+    )
     if not tag:
         raise HTTPException(404, detail="Tag not found")
-    res = tcol.update_one(
-        {"_id": tag["_id"]}, {"$set": {"pet_id": p.pet_id, "updated_at": _now()}}
-    )
-    if not res.matched_count:
-        raise HTTPException(500, detail="Failed to link tag")
-    pet = pcol.find_one({"_id": ObjectId(p.pet_id)})
+    await _invalidate_scan(p.code)
+    pet = await PET_COL.find_one({"_id": ObjectId(p.pet_id)}, {"name": 1})
     return {
         "success": True,
         "tag": {"code": tag["code"]},
@@ -159,52 +332,127 @@ def link_tag(p: LinkPayload):
 
 
 # Finder scan → urgent profile payload
-class FinderScanPayload(BaseModel):
+class FinderScanPayload(msgspec.Struct):
     code: str
     lat: Optional[float] = None
     lng: Optional[float] = None
     accuracy: Optional[float] = None
 
 
-@app.post("/scan")
-async def record_scan(p: FinderScanPayload, request: Request):
-    tcol = _collection("tag")
-    tag = tcol.find_one({"code": p.code})
-    if not tag or not tag.get("activated"):
-        raise HTTPException(404, detail="Tag not active")
+async def _fetch_scan_payload(code: str) -> Optional[Dict[str, Any]]:
+    """Read-only part of a scan: resolve tag → pet/owner, cached per code."""
+    data = _scan_local.get(code)
+    if data is not None:
+        return data
+
+    if cache is not None:
+        try:
+            hit = await cache.get(_scan_cache_key(code))
+            if hit:
+                data = _scan_local[code] = json.loads(hit)
+                return data
+        except Exception as e:
+            logger.warning("Scan cache read failed: %s", e)
+
+    # One round-trip: tag + pet + owner joined server-side. pet_id/owner_id are
+    # stored as strings, so convert them to ObjectIds before the $lookup.
+    docs = await TAG_COL.aggregate(
+        [
+            {"$match": {"code": code, "activated": True}},
+            {"$limit": 1},
+            {
+                "$addFields": {
+                    "pet_oid": {"$convert": {"input": "$pet_id", "to": "objectId", "onError": None, "onNull": None}},
+                    "owner_oid": {"$convert": {"input": "$owner_id", "to": "objectId", "onError": None, "onNull": None}},
+                }
+            },
+            {"$lookup": {"from": "pet", "localField": "pet_oid", "foreignField": "_id", "as": "pet"}},
+            {"$lookup": {"from": "user", "localField": "owner_oid", "foreignField": "_id", "as": "owner"}},
+            # Ship back only the fields the finder payload uses
+            {
+                "$project": {
+                    "_id": 0,
+                    "pet._id": 1,
+                    "pet.name": 1,
+                    "pet.photos": 1,
+                    "pet.medical_notes": 1,
+                    "pet.allergies": 1,
+                    "pet.status": 1,
+                    "pet.contact_visibility": 1,
+                    "owner._id": 1,
+                    "owner.phone": 1,
+                    "owner.tier": 1,
+                }
+            },
+        ]
+    ).to_list(length=1)
+    if not docs:
+        return None
+    doc = docs[0]
+
+    pet = doc["pet"][0] if doc["pet"] else None
+    owner = doc["owner"][0] if doc["owner"] else None
+
+    # Only expose the owner's phone when the pet profile allows it
+    visibility = (pet or {}).get("contact_visibility", "phone")
+    data: Dict[str, Any] = {
+        "pet_id": str(pet["_id"]) if pet else None,
+        "owner_id": str(owner["_id"]) if owner else None,
+        "tier": (owner or {}).get("tier", "basic"),
+        "status": (pet or {}).get("status", "ACTIVE"),
+        "pet": {
+            "name": (pet or {}).get("name"),
+            "photos": (pet or {}).get("photos", []),
+            "medical": {
+                "notes": (pet or {}).get("medical_notes"),
+                "allergies": (pet or {}).get("allergies"),
+            },
+        },
+        "contact": {
+            "visibility": visibility,
+            "phone": (owner or {}).get("phone") if visibility in ("phone", "both") else None,
+        },
+    }
 
-    # fetch pet & owner
-    pcol = _collection("pet")
-    ucol = _collection("user")
-    pet = (
-        pcol.find_one({"_id": ObjectId(tag.get("pet_id"))})
-        if tag.get("pet_id")
-        else None
-    )
-    owner = (
-        ucol.find_one({"_id": ObjectId(tag.get("owner_id"))})
-        if tag.get("owner_id")
-        else None
-    )
+    _scan_local[code] = data
+    if cache is not None:
+        try:
+            await cache.setex(_scan_cache_key(code), SCAN_CACHE_TTL, json.dumps(data))
+        except Exception as e:
+            logger.warning("Scan cache write failed: %s", e)
+    return data
 
-    # store scan event
-    scan_model = ScanEvent(
+
+async def _do_scan(
+    p: FinderScanPayload, user_agent: Optional[str] = None, referrer: Optional[str] = None
+) -> Dict[str, Any]:
+    data = await _fetch_scan_payload(p.code)
+    if data is None:
+        raise HTTPException(404, detail="Tag not active")
+
+    # queue scan event (every scan, cached or not)
+    now = _now()
+    scan_model = ScanEvent.model_construct(
         code=p.code,
-        pet_id=str(pet["_id"]) if pet else None,
-        owner_id=str(owner["_id"]) if owner else None,
-        timestamp=_now(),
+        pet_id=data["pet_id"],
+        owner_id=data["owner_id"],
+        timestamp=now,
         lat=p.lat,
         lng=p.lng,
         accuracy=p.accuracy,
-        user_agent=request.headers.get("user-agent"),
-        referrer=request.headers.get("referer"),
+        user_agent=user_agent,
+        referrer=referrer,
     )
-    create_document("scanevent", scan_model)
+    scan_doc = scan_model.model_dump()
+    scan_doc["created_at"] = scan_doc["updated_at"] = now
+    try:
+        _scan_queue.put_nowait(scan_doc)
+    except asyncio.QueueFull:
+        logger.warning("Scan queue full, dropping scan event for %s", p.code)
 
     # Premium: instant alert + GPS snapshot (stub)
-    tier = (owner or {}).get("tier", "basic")
     alert = None
-    if tier == "premium":
+    if data["tier"] == "premium":
         alert = {
             "type": "scan_alert",
             "delivered": True,
@@ -214,35 +462,26 @@ async def record_scan(p: FinderScanPayload, request: Request):
 
     # Response for finder urgent page
     payload: Dict[str, Any] = {
-        "status": (pet or {}).get("status", "ACTIVE"),
-        "pet": {
-            "name": (pet or {}).get("name"),
-            "photos": (pet or {}).get("photos", []),
-            "medical": {
-                "notes": (pet or {}).get("medical_notes"),
-                "allergies": (pet or {}).get("allergies"),
-            },
-        },
-        "contact": {
-            "visibility": (pet or {}).get("contact_visibility", "phone"),
-            "phone": (owner or {}).get("phone"),
-        },
-        "good_samaritan_offer": {
-            "headline": "Thank you for helping!",
-            "copy": "Get 50% off your first Whoofsy tag.",
-        },
+        "status": data["status"],
+        "pet": data["pet"],
+        "contact": data["contact"],
+        "good_samaritan_offer": _GS_OFFER,
         "premium_alert": alert,
     }
 
     return payload
 
 
+@app.post("/scan")
+async def record_scan(request: Request, p: FinderScanPayload = _msgspec_body(FinderScanPayload)):
+    return await _do_scan(p, request.headers.get("user-agent"), request.headers.get("referer"))
+
+
 # Test My Tag – simulate a scan for owner dashboard
 @app.post("/scan/test")
 async def test_my_tag(code: str):
     # Reuse scan without GPS
-    dummy_request = Request(scope={"type": "http", "headers": []})
-    return await record_scan(FinderScanPayload(code=code), dummy_request)
+    return await _do_scan(FinderScanPayload(code=code))
 
 
 # Good Samaritan coupon creation (one-time after reunion)
@@ -251,41 +490,48 @@ class ReunionPayload(BaseModel):
 
 
 @app.post("/reunion")
-def mark_reunion(p: ReunionPayload):
+async def mark_reunion(p: ReunionPayload):
     # create a one-time coupon if not exists
-    col = _collection("coupon")
-    existing = col.find_one({"code": p.code, "redeemed": False})
-    if existing:
-        existing["id"] = str(existing["_id"])  # normalize
-        return existing
-    coupon = Coupon(code=p.code, redeemed=False, created_at=_now())
-    create_document("coupon", coupon)
-    saved = col.find_one({"code": p.code, "redeemed": False})
-    saved["id"] = str(saved["_id"])  # normalize
+    now = _now()
+    coupon = Coupon(code=p.code, redeemed=False, created_at=now)
+    saved = await COUPON_COL.find_one_and_update(
+        {"code": p.code, "redeemed": False},
+        {"$setOnInsert": {**coupon.model_dump(), "updated_at": now}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    saved["id"] = str(saved.pop("_id"))  # normalize
     return saved
 
 
 @app.get("/test")
-def test_database():
+async def test_database():
     resp = {
         "backend": "✅ Running",
-        "database": "❌ Not Available" if db is None else "✅ Connected",
+        "database": "✅ Connected",
         "collections": [],
     }
     try:
-        if db:
-            resp["collections"] = db.list_collection_names()
+        resp["collections"] = await db.list_collection_names()
     except Exception as e:
         resp["database"] = f"⚠️ {str(e)[:80]}"
     return resp
 
 
 @app.get("/")
-def root():
+async def root():
     return {"message": "Whoofsy backend is live"}
 
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # Import string (not the app object) is required when workers > 1
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=port,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WORKERS", 2)),
+    )